@@ -40,10 +40,13 @@ class Rotary(torch.nn.Module):
         seq_len = x.shape[1]
         if seq_len != self.seq_len_cached:
             self.seq_len_cached = seq_len
-            t = torch.arange(seq_len, device=x.device).type_as(self.inv_freq)
-            freqs = torch.outer(t, self.inv_freq).to(x.device)
-            self.cos_cached = freqs.cos()
-            self.sin_cached = freqs.sin()
+            # outside inference mode, so that a cache filled by an inference
+            # forward can still be saved for backward in training
+            with torch.inference_mode(False):
+                t = torch.arange(seq_len, device=x.device).type_as(self.inv_freq)
+                freqs = torch.outer(t, self.inv_freq).to(x.device)
+                self.cos_cached = freqs.cos()
+                self.sin_cached = freqs.sin()
         return self.cos_cached[None, :, None, :], self.sin_cached[None, :, None, :]
 
 
@@ -58,6 +61,32 @@ def apply_rotary_emb(x, cos, sin):
     return torch.cat([y1, y2], 3)
 
 
+def activation_dtype(x: torch.Tensor) -> torch.dtype:
+    """Dtype of the activations computed from x, the autocast dtype when enabled."""
+    return torch.get_autocast_dtype(x.device.type) if torch.is_autocast_enabled(x.device.type) else x.dtype
+
+
+def causal_pom_mask(T: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """
+    Normalized causal mask for PoM, see pom.normalize_mask.
+    
+    Row i is 1 / (i + 1) up to the diagonal. The mask is built in place in
+    the target dtype, without (T, T) temporaries. The row denominators stay
+    in float32 so that they are exact in bfloat16 beyond T = 256.
+    
+    Args:
+        T: Sequence length
+        device: Device of the mask
+        dtype: Data type of the mask, see activation_dtype
+        
+    Returns:
+        Mask of shape (1, T, T)
+    """
+    mask = torch.ones((T, T), device=device, dtype=dtype).tril_()
+    mask.div_(torch.arange(1, T + 1, device=device, dtype=torch.float32).unsqueeze(-1))
+    return mask.unsqueeze(0)
+
+
 class CausalSelfPoM(nn.Module):
     """Causal self-attention using Polynomial Mixer."""
     
@@ -70,10 +99,16 @@ class CausalSelfPoM(nn.Module):
         self.head_dim = self.n_embd // self.n_head
         self.pom = pom.PoM(self.n_embd, self.degree, self.expand, self.n_head, False)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        B, T, C = x.size()
-        mask = torch.tril(torch.ones((T, T))).unsqueeze(0)
-        return self.pom(x, x, mask)
+    def forward(self, x: torch.Tensor, mask: torch.Tensor = None) -> torch.Tensor:
+        """
+        Args:
+            x: Input tensor of shape (batch, seq_len, n_embd)
+            mask: Optional causal mask from causal_pom_mask, shared by all the
+                layers of a model, built here when not given
+        """
+        if mask is None:
+            mask = causal_pom_mask(x.shape[1], x.device, activation_dtype(x))
+        return self.pom(x, x, mask, mask_normalized=True)
 
 class CausalSelfAttention(nn.Module):
 
@@ -148,8 +183,11 @@ class Block(nn.Module):
         self.mlp = MLP(n_embd)
         self.attn_scale = (1 / (2 * n_layer)**0.5)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x + self.attn_scale * self.attn(rmsnorm(x))
+    def forward(self, x: torch.Tensor, pom_mask: torch.Tensor = None) -> torch.Tensor:
+        if isinstance(self.attn, CausalSelfPoM):
+            x = x + self.attn_scale * self.attn(rmsnorm(x), pom_mask)
+        else:
+            x = x + self.attn_scale * self.attn(rmsnorm(x))
         x = x + self.mlp(rmsnorm(x))
         return x
 
@@ -172,6 +210,18 @@ class GPT(nn.Module):
         self.lm_head = nn.Linear(self.n_embd, self.vocab_size, bias=False)
         self.transformer.wte.weight = self.lm_head.weight  # weight tying
         self.rotary = Rotary(self.head_dim)
+        self.pom_mask_cached = None
+
+    def pom_mask(self, x: torch.Tensor) -> torch.Tensor:
+        """Causal mask shared by the PoM layers, cached across forwards."""
+        T, dtype = x.shape[1], activation_dtype(x)
+        cached = self.pom_mask_cached
+        if cached is None or cached.shape[-1] != T or cached.device != x.device or cached.dtype != dtype:
+            # outside inference mode, so that a mask first cached by an
+            # inference forward can still be saved for backward in training
+            with torch.inference_mode(False):
+                self.pom_mask_cached = causal_pom_mask(T, x.device, dtype)
+        return self.pom_mask_cached
 
     def forward(self, idx: torch.Tensor, targets: torch.Tensor = None, return_logits: bool = True):
         """
@@ -197,8 +247,13 @@ class GPT(nn.Module):
         x = apply_rotary_emb(x, cos, sin)
         x = x.view(B, T, C)
 
+        # normalized once here and shared by every PoM layer instead of each
+        # layer keeping its own (1, T, T) copy
+        pom_mask = None
+        if any(isinstance(block.attn, CausalSelfPoM) for block in self.transformer.h):
+            pom_mask = self.pom_mask(x)
         for block in self.transformer.h:
-            x = block(x)
+            x = block(x, pom_mask)
         x = rmsnorm(x)
 
         if targets is not None:
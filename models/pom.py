@@ -1,145 +1,241 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch._dynamo
-from typing import Optional, Tuple, Dict, Any
+import functools
+import math
+from typing import Callable, Optional, Tuple, Dict, Any
 import einops
 
-torch._dynamo.config.suppress_errors = True
+from models.pom_triton import HAS_TRITON
+if HAS_TRITON:
+    from models.pom_triton import fused_polynomial_aggregation
+
+try:
+    from torch.nn.attention.flex_attention import BlockMask, flex_attention
+    HAS_FLEX_ATTENTION = True
+except ImportError:
+    HAS_FLEX_ATTENTION = False
+
+try:
+    from torch._dynamo import is_dynamo_supported
+    HAS_DYNAMO = is_dynamo_supported()
+except Exception:
+    HAS_DYNAMO = False
 
 # =============================================================================
 # Core Polynomial Functions
 # =============================================================================
 
-@torch.compile
 def gelu(x: torch.Tensor) -> torch.Tensor:
-    """Apply GELU activation function with torch.compile optimization."""
+    """Apply GELU activation function."""
     return F.gelu(x)
 
-@torch.compile
-def po2(x: torch.Tensor) -> torch.Tensor:
+def polynomial_expansion(x: torch.Tensor, k: int) -> torch.Tensor:
     """
-    Second-order polynomial expansion.
+    Polynomial expansion of order k.
+    
+    Built in full for the mixers that aggregate into several query tokens,
+    see polynomial_aggregation_.
     
     Args:
         x: Input tensor of shape (..., dim)
+        k: Polynomial order
         
     Returns:
-        Tensor of shape (..., 2*dim) with polynomial interactions
+        Tensor of shape (..., dim) where the i-th of k chunks is the product
+        of the first i+1 chunks of gelu(x)
     """
-    h1, h2 = gelu(x).chunk(2, dim=-1)
-    h2 = h2 * h1
-    return torch.cat([h1, h2], dim=-1)
+    if k == 1:
+        return gelu(x)
+    # one code path for every order; chunk products rather than a cumprod over
+    # a (..., k, dim // k) view, whose forward and backward are several times
+    # slower both eager and compiled
+    h = gelu(x).chunk(k, dim=-1)
+    out = [h[0]]
+    for i in range(1, k):
+        out.append(out[i - 1] * h[i])
+    return torch.cat(out, dim=-1)
 
-@torch.compile
-def po3(x: torch.Tensor) -> torch.Tensor:
+# =============================================================================
+# Masking and Aggregation Functions
+# =============================================================================
+
+def normalize_mask(mask: torch.Tensor) -> torch.Tensor:
     """
-    Third-order polynomial expansion.
+    Normalize an attention mask so that it sums to one over the context.
+    
+    The normalized mask only depends on the mask itself, so it can be computed
+    once and shared by every layer instead of re-reducing it in each mixer.
     
     Args:
-        x: Input tensor of shape (..., dim)
+        mask: Attention mask of shape (batch, seq_len) or
+            (batch, query_len, seq_len)
         
     Returns:
-        Tensor of shape (..., 3*dim) with polynomial interactions
+        Normalized mask of the same shape
     """
-    h1, h2, h3 = gelu(x).chunk(3, dim=-1)
-    h2 = h2 * h1
-    h3 = h3 * h2
-    return torch.cat([h1, h2, h3], dim=-1)
+    return mask * torch.reciprocal(1.e-7 + mask.sum(dim=-1, keepdim=True))
 
-@torch.compile
-def po4(x: torch.Tensor) -> torch.Tensor:
+def mask_mixer(h: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
     """
-    Fourth-order polynomial expansion.
+    Apply 2D mask mixing for attention.
     
     Args:
-        x: Input tensor of shape (..., dim)
+        h: Hidden states tensor of shape (batch, seq_len, dim)
+        mask: Normalized attention mask of shape (batch, seq_len), on the
+            device and with the dtype of h
         
     Returns:
-        Tensor of shape (..., 4*dim) with polynomial interactions
+        Masked and aggregated tensor of shape (batch, 1, dim)
     """
-    h1, h2, h3, h4 = gelu(x).chunk(4, dim=-1)
-    h2 = h2 * h1
-    h3 = h3 * h2
-    h4 = h4 * h3
-    return torch.cat([h1, h2, h3, h4], dim=-1)
-
-# =============================================================================
-# Masking and Aggregation Functions
-# =============================================================================
+    return (h * mask.unsqueeze(-1)).sum(dim=1, keepdims=True)
 
-def mask_mixer(h: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+def full_mask_mixer(h: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
     """
-    Apply 2D mask mixing for attention.
+    Apply 3D mask mixing for cross-attention.
     
     Args:
         h: Hidden states tensor of shape (batch, seq_len, dim)
-        mask: Attention mask of shape (batch, seq_len)
+        mask: Normalized attention mask of shape (batch, query_len, seq_len), on
+            the device and with the dtype of h
         
     Returns:
-        Masked and aggregated tensor of shape (batch, 1, dim)
+        Masked and aggregated tensor of shape (batch, query_len, dim)
     """
-    return (h * mask.unsqueeze(-1)).sum(dim=1, keepdims=True) / (1.e-7 + mask.unsqueeze(-1).sum(dim=1, keepdims=True))
+    # (b, m, n) @ (b, n, d) -> (b, m, d), b batch, n context tokens, m query tokens, d dim;
+    # a mask shared by the batch is expanded as a view
+    return torch.bmm(mask.expand(h.shape[0], -1, -1), h)
 
-def full_mask_mixer(h: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+def block_mask_mixer(h: torch.Tensor, block_mask: 'BlockMask') -> torch.Tensor:
     """
-    Apply 3D mask mixing for cross-attention.
+    Apply structured mask mixing with FlexAttention.
+    
+    With all-zero queries and keys every score is equal, so the softmax puts a
+    uniform weight on the positions allowed by block_mask and the attention
+    output is the same masked mean as full_mask_mixer. Blocks that are fully
+    masked out (e.g. above the diagonal of a causal mask) are skipped, instead
+    of being multiplied by zero.
     
     Args:
         h: Hidden states tensor of shape (batch, seq_len, dim)
-        mask: Attention mask of shape (batch, query_len, seq_len)
+        block_mask: BlockMask of shape (batch or 1, 1, query_len, seq_len)
         
     Returns:
         Masked and aggregated tensor of shape (batch, query_len, dim)
     """
-    mask = mask.type(h.dtype)
-    h = torch.einsum('bnd, bmn -> bmd', h, mask)  # b batch, n context tokens, m query tokens, d dim
-    h = h / (1.e-7 + mask.sum(dim=2, keepdims=True))
-    return h
+    B, N, D = h.shape
+    M = block_mask.seq_lengths[0]
+    head_dim = math.gcd(D, 64)
+    v = h.unflatten(-1, (-1, head_dim)).transpose(1, 2)  # (batch, heads, seq_len, head_dim)
+    q = h.new_zeros((B, v.shape[1], M, 16))
+    k = h.new_zeros((B, v.shape[1], N, 16))
+    return flex_attention(q, k, v, block_mask=block_mask).transpose(1, 2).flatten(-2)
+
+def mean_mixer(h: torch.Tensor) -> torch.Tensor:
+    """
+    Average hidden states over the whole context.
+    
+    Args:
+        h: Hidden states tensor of shape (batch, seq_len, dim)
+        
+    Returns:
+        Aggregated tensor of shape (batch, 1, dim)
+    """
+    return h.mean(dim=1, keepdims=True)
+
+def select_mixer(mask: Optional[torch.Tensor] = None,
+                 block_mask: Optional['BlockMask'] = None) -> Callable[[torch.Tensor], torch.Tensor]:
+    """
+    Resolve the aggregation over the context for a given mask.
+    
+    The dispatch on the mask shape is done once here rather than for every
+    polynomial order.
+    
+    Args:
+        mask: Optional normalized attention mask of shape (batch, seq_len) or
+            (batch, query_len, seq_len), see normalize_mask, on the device and
+            with the dtype of the hidden states
+        block_mask: Optional FlexAttention BlockMask used instead of mask for
+            structured (e.g. causal or sliding window) patterns
+        
+    Returns:
+        Function mapping hidden states of shape (batch, seq_len, dim) to the
+        aggregated tensor of shape (batch, 1, dim) or (batch, query_len, dim)
+    """
+    if block_mask is not None:
+        if not HAS_FLEX_ATTENTION:
+            raise ValueError('block_mask requires torch.nn.attention.flex_attention, which is not available.')
+        return functools.partial(block_mask_mixer, block_mask=block_mask)
+    if mask is None:
+        return mean_mixer
+    if mask.dim() == 2:
+        return functools.partial(mask_mixer, mask=mask)
+    if mask.dim() == 3:
+        return functools.partial(full_mask_mixer, mask=mask)
+    raise ValueError(f'Unsupported mask dimension: {mask.dim()}. Expected 2, 3, or None.')
 
 # =============================================================================
 # Polynomial Aggregation and Selection
 # =============================================================================
 
-def polynomial_aggregation_(x: torch.Tensor, k: int, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+def polynomial_aggregation_(x: torch.Tensor, k: int, mask: Optional[torch.Tensor] = None,
+                            h_past: Optional[torch.Tensor] = None, n_past: int = 0,
+                            block_mask: Optional['BlockMask'] = None) -> torch.Tensor:
     """
     Apply polynomial aggregation with optional masking.
     
     Args:
         x: Input tensor of shape (batch, seq_len, dim)
-        k: Polynomial order (2, 3, 4, or higher)
-        mask: Optional attention mask
+        k: Polynomial order
+        mask: Optional normalized attention mask, see normalize_mask
+        h_past: Optional aggregate over n_past previous tokens to blend into
+            the result for incremental processing, only supported without mask
+        n_past: Number of tokens aggregated in h_past
+        block_mask: Optional FlexAttention BlockMask replacing mask for
+            structured patterns, see block_mask_mixer
         
     Returns:
         Aggregated tensor with polynomial interactions
     """
-    # Use optimized functions for common cases
-    if k == 2:
-        h = po2(x)
-    elif k == 3:
-        h = po3(x)
-    elif k == 4:
-        h = po4(x)
+    if (mask is not None or block_mask is not None) and h_past is not None:
+        raise ValueError('h_past is only supported without mask.')
+    if mask is not None and block_mask is not None:
+        raise ValueError('Pass either mask or block_mask, not both.')
+
+    # Only cast when needed, the usual cached mask is already ready to use and
+    # an unconditional .to() is an extra dispatch on every layer.
+    if mask is not None and (mask.device != x.device or mask.dtype != x.dtype):
+        mask = mask.to(x.device, x.dtype, non_blocking=True)
+
+    if HAS_TRITON and x.is_cuda and block_mask is None and (mask is None or mask.dim() == 2):
+        return fused_polynomial_aggregation(x, k, mask, h_past, n_past)
+
+    mixer = select_mixer(mask, block_mask)
+    if k == 1 or block_mask is not None or (mask is not None and mask.dim() == 3):
+        # Mixing into query_len tokens is a GEMM over the context whose output
+        # is as large as the expansion, so it runs once over all the orders:
+        # one GEMM per order would read the mask k times and then concatenate
+        # (batch, query_len, dim) outputs. A single order has nothing to split.
+        h = mixer(polynomial_expansion(x, k))
     else:
-        # Generic case for k > 4
-        h = list(gelu(x).chunk(k, dim=-1))
+        # The activated input is split into k chunks and order i is the product
+        # of the first i+1 chunks. Mean and 2D mask mixers reduce the context
+        # to a single token and are linear along the feature axis, so each
+        # order is reduced as soon as it is formed and only the running product
+        # and the (batch, 1, dim) aggregates are kept alive instead of the full
+        # expansion.
+        h = gelu(x).chunk(k, dim=-1)
+        p = h[0]
+        out = [mixer(p)]
         for i in range(1, k):
-            h[i] = h[i] * h[i-1]
-        h = torch.cat(h, dim=-1)
-    
-    # Apply masking if provided
-    if mask is None:
-        h = h.mean(dim=1, keepdims=True)
-    else:
-        if mask.dim() == 2:
-            h = mask_mixer(h, mask.to(h.device))
-        elif mask.dim() == 3:
-            h = full_mask_mixer(h, mask.to(h.device))
-        else:
-            raise ValueError(f'Unsupported mask dimension: {mask.dim()}. Expected 2, 3, or None.')
+            p = p * h[i]
+            out.append(mixer(p))
+        h = torch.cat(out, dim=-1)
+    if h_past is not None:
+        # (n_past * h_past + n * h) / (n_past + n) as a single lerp
+        h = torch.lerp(h_past, h, x.shape[1] / (n_past + x.shape[1]))
     return h
 
-@torch.compile
 def polynomial_selection_(x: torch.Tensor, h: torch.Tensor, n_head: int) -> torch.Tensor:
     """
     Apply polynomial selection with sigmoid gating.
@@ -147,11 +243,14 @@ def polynomial_selection_(x: torch.Tensor, h: torch.Tensor, n_head: int) -> torc
     Args:
         x: Query tensor
         h: Context tensor from polynomial aggregation
+        n_head: Number of heads sharing each gate value
         
     Returns:
         Gated output tensor
     """
-    return F.sigmoid(x).repeat_interleave(n_head, dim=-1) * h
+    # Broadcast each gate over its n_head channels instead of materializing
+    # the repeat_interleave'd gate at the full context width.
+    return (F.sigmoid(x).unsqueeze(-1) * h.unflatten(-1, (-1, n_head))).flatten(-2)
 
 # =============================================================================
 # Main PoM Function
@@ -173,6 +272,8 @@ def pom(xq: torch.Tensor, xc: torch.Tensor, k: int, n_head: int, mask: Optional[
     Returns:
         Output tensor after polynomial mixing
     """
+    if mask is not None:
+        mask = normalize_mask(mask)
     h = polynomial_aggregation_(xc, k, mask)
     o = polynomial_selection_(xq, h, n_head)
     return o
@@ -196,7 +297,6 @@ class PoM(nn.Module):
         po_proj (nn.Linear): Linear projection for polynomial computation
         se_proj (nn.Linear): Linear projection for selection mechanism
         ag_proj (nn.Linear): Linear projection for output aggregation
-        pom (callable): The polynomial mixer operation function
     """
     
     def __init__(self, dim: int, degree: int, expand: int, n_head: int, bias: bool = True):
@@ -221,10 +321,18 @@ class PoM(nn.Module):
         self.po_proj = nn.Conv1d(dim, degree * expand * dim, kernel_size=1, bias=bias, groups=self.n_head)
         self.se_proj = nn.Linear(dim, self.head_dim, bias=bias)
         self.ag_proj = nn.Linear(degree * expand * dim, dim, bias=bias)
-        self.pom = pom
+        # Compile the whole projection -> PoM -> projection graph once rather
+        # than each small helper on its own. The unbound method is compiled so
+        # that deep copies of this module (see models.gpt.Block) run with their
+        # own parameters.
+        if HAS_DYNAMO:
+            self._compiled_forward = torch.compile(type(self)._forward_impl, mode="default")
+        else:
+            self._compiled_forward = type(self)._forward_impl
 
     def forward(self, xq: torch.Tensor, xc: Optional[torch.Tensor] = None, 
-                mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+                mask: Optional[torch.Tensor] = None, mask_normalized: bool = False,
+                block_mask: Optional['BlockMask'] = None) -> torch.Tensor:
         """
         Forward pass of the PoM module.
         
@@ -232,18 +340,68 @@ class PoM(nn.Module):
             xq: Query input tensor of shape (batch, n_tokens, dim)
             xc: Context input tensor. If None, self-attention is performed
             mask: Optional attention mask tensor
+            mask_normalized: Whether mask was already passed through
+                normalize_mask, e.g. when it is shared by several layers
+            block_mask: Optional FlexAttention BlockMask to use instead of mask
+                when the mask is a structured pattern (causal, sliding window),
+                so that fully masked blocks are skipped
             
         Returns:
             Output tensor after applying the PoM operation
         """
+        return self._compiled_forward(self, xq, xc, mask, mask_normalized, block_mask)
+
+    def _forward_impl(self, xq: torch.Tensor, xc: Optional[torch.Tensor] = None,
+                      mask: Optional[torch.Tensor] = None, mask_normalized: bool = False,
+                      block_mask: Optional['BlockMask'] = None) -> torch.Tensor:
         if xc is None:
             xc = xq  # self-attention
+        if mask is not None and not mask_normalized:
+            mask = normalize_mask(mask)
 
         s = self.se_proj(xq)
-        h = self.po_proj(xc.transpose(1, 2)).transpose(1, 2)
-        sh = self.pom(s, h, self.order, self.n_head, mask)
+        h = self._project(xc)
+        h = polynomial_aggregation_(h, self.order, mask, block_mask=block_mask)
+        sh = polynomial_selection_(s, h, self.n_head)
 
-        return self.ag_proj(sh)
+        return self._aggregate(sh)
+
+    def _project(self, xc: torch.Tensor) -> torch.Tensor:
+        """
+        Apply po_proj to a (batch, n_tokens, dim) context.
+        
+        Without grouping the 1x1 convolution is a plain GEMM, so it goes
+        through F.linear: the output comes out channels-last and contiguous,
+        and the GELU at the start of the aggregation can be fused into its
+        epilogue when compiled. Grouped projections keep the convolution.
+        
+        Args:
+            xc: Context input tensor of shape (batch, n_tokens, dim)
+            
+        Returns:
+            Projected tensor of shape (batch, n_tokens, degree * expand * dim)
+        """
+        if self.po_proj.groups == 1:
+            return F.linear(xc, self.po_proj.weight.squeeze(-1), self.po_proj.bias)
+        return self.po_proj(xc.transpose(1, 2)).transpose(1, 2)
+
+    def _aggregate(self, sh: torch.Tensor) -> torch.Tensor:
+        """
+        Apply ag_proj as a single 2D GEMM with the bias in its epilogue.
+        
+        Args:
+            sh: Gated tensor of shape (batch, n_tokens, degree * expand * dim)
+            
+        Returns:
+            Output tensor of shape (batch, n_tokens, dim)
+        """
+        weight, bias = self.ag_proj.weight, self.ag_proj.bias
+        sh_flat = sh.reshape(-1, sh.shape[-1])
+        if bias is None:
+            out = torch.mm(sh_flat, weight.t())
+        else:
+            out = torch.addmm(bias, sh_flat, weight.t())
+        return out.view(*sh.shape[:-1], weight.shape[0])
 
     def state_forward(self, xq: torch.Tensor, xc: Optional[torch.Tensor] = None, 
                      state: Optional[Dict[str, Any]] = None) -> Tuple[torch.Tensor, Dict[str, Any]]:
@@ -262,19 +420,12 @@ class PoM(nn.Module):
             xc = xq  # self-attention
 
         s = self.se_proj(xq)
-        xc = self.po_proj(xc.transpose(1, 2)).transpose(1, 2)
-        h_current = polynomial_aggregation_(xc, self.order)
-        n_current = h_current.shape[1]
-
-        if state is not None:
-            h_past = state['h']
-            n_past = state['n']
-            h = (n_past * h_past + n_current * h_current) / (n_past + n_current)
-        else:
-            h = h_current
-            n_past = 0
+        xc = self._project(xc)
+        h_past = state['h'] if state is not None else None
+        n_past = state['n'] if state is not None else 0
+        h = polynomial_aggregation_(xc, self.order, h_past=h_past, n_past=n_past)
 
-        new_state = {'h': h, 'n': n_past + n_current}
+        new_state = {'h': h, 'n': n_past + xc.shape[1]}
 
-        sh = polynomial_selection_(s, h)
-        return self.ag_proj(sh), new_state
\ No newline at end of file
+        sh = polynomial_selection_(s, h, self.n_head)
+        return self._aggregate(sh), new_state
\ No newline at end of file
@@ -0,0 +1,220 @@
+import torch
+from typing import Optional, Tuple
+
+try:
+    import triton
+    import triton.language as tl
+    HAS_TRITON = True
+except ImportError:
+    HAS_TRITON = False
+
+# =============================================================================
+# Fused Polynomial Aggregation Kernels
+# =============================================================================
+#
+# Fuse GELU, the prefix products over the k chunks and the (masked) mean over
+# the context of polynomial_aggregation_ into a single pass over the input.
+# A program owns one batch element and a block of channels of every chunk and
+# streams (k, BLOCK_C, BLOCK_S) tiles along the sequence while the per-order
+# sums stay in registers. Tiling both the channel and the sequence axis keeps
+# the loads coalesced whichever of the two is contiguous: po_proj returns a
+# transposed (batch, seq_len, dim) view of the convolution output, with
+# stride 1 along the sequence, while the linear path is channels-last.
+
+if HAS_TRITON:
+
+    @triton.jit
+    def _gelu(x):
+        return 0.5 * x * (1.0 + tl.math.erf(x * 0.7071067811865476))
+
+    @triton.jit
+    def _gelu_grad(x):
+        cdf = 0.5 * (1.0 + tl.math.erf(x * 0.7071067811865476))
+        pdf = 0.3989422804014327 * tl.exp(-0.5 * x * x)
+        return cdf + x * pdf
+
+    @triton.jit
+    def _row(a, rows, j):
+        # extract row j of a (K_PAD, ...) tile, zero if j is out of range
+        return tl.sum(tl.where(rows == j, a, 0.0), axis=0)
+
+    @triton.jit
+    def _polynomial_aggregation_fwd_kernel(
+        x_ptr, mask_ptr, past_ptr, out_ptr,
+        S, C, n_past,
+        stride_xb, stride_xs, stride_xd,
+        stride_mb, stride_ms,
+        K: tl.constexpr, K_PAD: tl.constexpr, HAS_MASK: tl.constexpr, HAS_PAST: tl.constexpr,
+        BLOCK_C: tl.constexpr, BLOCK_S: tl.constexpr,
+    ):
+        pid_b = tl.program_id(0)
+        pid_c = tl.program_id(1)
+        offs_k = tl.arange(0, K_PAD)[:, None, None]
+        offs_c = pid_c * BLOCK_C + tl.arange(0, BLOCK_C)[None, :, None]
+        d_mask = (offs_k < K) & (offs_c < C)
+        x_ptrs = x_ptr + pid_b * stride_xb + (offs_k * C + offs_c) * stride_xd
+
+        # padded positions load 0 and gelu(0) = 0, so they add nothing
+        acc = tl.zeros((K_PAD, BLOCK_C), dtype=tl.float32)
+        for s0 in range(0, S, BLOCK_S):
+            offs_s = s0 + tl.arange(0, BLOCK_S)[None, None, :]
+            x = tl.load(x_ptrs + offs_s * stride_xs, mask=d_mask & (offs_s < S), other=0.0).to(tl.float32)
+            p = tl.cumprod(_gelu(x), axis=0)
+            if HAS_MASK:
+                m = tl.load(mask_ptr + pid_b * stride_mb + offs_s * stride_ms, mask=offs_s < S, other=0.0)
+                p = p * m.to(tl.float32)
+            acc += tl.sum(p, axis=2)
+
+        offs_k = tl.arange(0, K_PAD)[:, None]
+        offs_c = pid_c * BLOCK_C + tl.arange(0, BLOCK_C)[None, :]
+        out_mask = (offs_k < K) & (offs_c < C)
+        offs_d = pid_b * K * C + offs_k * C + offs_c
+        if HAS_PAST:
+            # streaming update: blend with the running mean over the n_past
+            # previously seen tokens
+            past = tl.load(past_ptr + offs_d, mask=out_mask, other=0.0).to(tl.float32)
+            acc = (n_past * past + acc) * (1.0 / (n_past + S))
+        elif not HAS_MASK:
+            acc = acc * (1.0 / S)
+        tl.store(out_ptr + offs_d, acc.to(out_ptr.dtype.element_ty), mask=out_mask)
+
+    @triton.jit
+    def _polynomial_aggregation_bwd_kernel(
+        x_ptr, mask_ptr, grad_ptr, dx_ptr,
+        S, C,
+        stride_xb, stride_xs, stride_xd,
+        stride_mb, stride_ms,
+        stride_dxb, stride_dxs, stride_dxd,
+        S_TOTAL,
+        K: tl.constexpr, K_PAD: tl.constexpr, HAS_MASK: tl.constexpr,
+        BLOCK_C: tl.constexpr, BLOCK_S: tl.constexpr,
+    ):
+        pid_b = tl.program_id(0)
+        pid_s = tl.program_id(1)
+        pid_c = tl.program_id(2)
+        offs_k = tl.arange(0, K_PAD)[:, None, None]
+        offs_c = pid_c * BLOCK_C + tl.arange(0, BLOCK_C)[None, :, None]
+        offs_s = pid_s * BLOCK_S + tl.arange(0, BLOCK_S)[None, None, :]
+        d_mask = (offs_k < K) & (offs_c < C)
+        tile_mask = d_mask & (offs_s < S)
+        offs_d = offs_k * C + offs_c
+
+        x = tl.load(x_ptr + pid_b * stride_xb + offs_s * stride_xs + offs_d * stride_xd,
+                    mask=tile_mask, other=0.0).to(tl.float32)
+        g = tl.load(grad_ptr + pid_b * K * C + offs_d, mask=d_mask, other=0.0).to(tl.float32)
+        h = _gelu(x)
+        p = tl.cumprod(h, axis=0)
+
+        # order i is p_i = h_0 * ... * h_i, so the gradient w.r.t. h_j is
+        # p_{j-1} * t_j with t_j = g_j + h_{j+1} * t_{j+1} (Horner from the top)
+        t = tl.zeros((BLOCK_C, BLOCK_S), dtype=tl.float32)
+        dh = tl.zeros((K_PAD, BLOCK_C, BLOCK_S), dtype=tl.float32)
+        for i in tl.static_range(K):
+            j = K - 1 - i
+            t = _row(g, offs_k, j) + _row(h, offs_k, j + 1) * t
+            p_prev = tl.full((BLOCK_C, BLOCK_S), 1.0, dtype=tl.float32)
+            if j > 0:
+                p_prev = _row(p, offs_k, j - 1)
+            dh += tl.where(offs_k == j, (p_prev * t)[None, :, :], 0.0)
+
+        if HAS_MASK:
+            w = tl.load(mask_ptr + pid_b * stride_mb + offs_s * stride_ms, mask=offs_s < S, other=0.0).to(tl.float32)
+        else:
+            w = 1.0 / S_TOTAL
+        dx = dh * _gelu_grad(x) * w
+        dx_ptrs = dx_ptr + pid_b * stride_dxb + offs_s * stride_dxs + offs_d * stride_dxd
+        tl.store(dx_ptrs, dx.to(dx_ptr.dtype.element_ty), mask=tile_mask)
+
+    def _launch_config(C: int, S: int) -> Tuple[int, int]:
+        return min(triton.next_power_of_2(C), 32), min(triton.next_power_of_2(S), 32)
+
+    # =========================================================================
+    # Custom Op Registration
+    # =========================================================================
+
+    @torch.library.custom_op("pom::polynomial_aggregation", mutates_args=())
+    def fused_polynomial_aggregation(x: torch.Tensor, k: int, mask: Optional[torch.Tensor] = None,
+                                     h_past: Optional[torch.Tensor] = None, n_past: int = 0) -> torch.Tensor:
+        """
+        Fused polynomial aggregation for a 2D mask or no mask.
+
+        Args:
+            x: Input tensor of shape (batch, seq_len, dim), on a CUDA device
+            k: Polynomial order, must divide dim
+            mask: Optional normalized attention mask of shape (batch, seq_len)
+                or (1, seq_len) when shared by the batch
+            h_past: Optional running mean of shape (batch, 1, dim) over the
+                n_past previous tokens to blend into the result, only
+                supported without mask
+            n_past: Number of tokens aggregated in h_past
+
+        Returns:
+            Aggregated tensor of shape (batch, 1, dim)
+        """
+        if mask is not None and h_past is not None:
+            raise ValueError('h_past is only supported without mask.')
+        B, S, D = x.shape
+        C = D // k
+        if mask is not None:
+            # the kernel indexes the mask by batch, a shared mask gets stride 0
+            mask = mask.expand(B, -1)
+        out = torch.empty((B, 1, D), device=x.device, dtype=x.dtype)
+        block_c, block_s = _launch_config(C, S)
+        _polynomial_aggregation_fwd_kernel[(B, triton.cdiv(C, block_c))](
+            x, mask if mask is not None else x, h_past.contiguous() if h_past is not None else x, out,
+            S, C, n_past,
+            x.stride(0), x.stride(1), x.stride(2),
+            mask.stride(0) if mask is not None else 0, mask.stride(1) if mask is not None else 0,
+            K=k, K_PAD=triton.next_power_of_2(k), HAS_MASK=mask is not None, HAS_PAST=h_past is not None,
+            BLOCK_C=block_c, BLOCK_S=block_s,
+        )
+        return out
+
+    @fused_polynomial_aggregation.register_fake
+    def _(x: torch.Tensor, k: int, mask: Optional[torch.Tensor] = None,
+          h_past: Optional[torch.Tensor] = None, n_past: int = 0) -> torch.Tensor:
+        B, S, D = x.shape
+        return x.new_empty((B, 1, D))
+
+    @torch.library.custom_op("pom::polynomial_aggregation_backward", mutates_args=())
+    def fused_polynomial_aggregation_backward(grad: torch.Tensor, x: torch.Tensor, k: int,
+                                              mask: Optional[torch.Tensor] = None, n_past: int = 0) -> torch.Tensor:
+        B, S, D = x.shape
+        C = D // k
+        if mask is not None:
+            mask = mask.expand(B, -1)
+        grad = grad.contiguous()
+        # same layout as x, so that the po_proj backward gets its gradient
+        # without a copy
+        dx = torch.empty_like(x)
+        block_c, block_s = _launch_config(C, S)
+        _polynomial_aggregation_bwd_kernel[(B, triton.cdiv(S, block_s), triton.cdiv(C, block_c))](
+            x, mask if mask is not None else x, grad, dx,
+            S, C,
+            x.stride(0), x.stride(1), x.stride(2),
+            mask.stride(0) if mask is not None else 0, mask.stride(1) if mask is not None else 0,
+            dx.stride(0), dx.stride(1), dx.stride(2),
+            n_past + S,
+            K=k, K_PAD=triton.next_power_of_2(k), HAS_MASK=mask is not None, BLOCK_C=block_c, BLOCK_S=block_s,
+        )
+        return dx
+
+    @fused_polynomial_aggregation_backward.register_fake
+    def _(grad: torch.Tensor, x: torch.Tensor, k: int, mask: Optional[torch.Tensor] = None,
+          n_past: int = 0) -> torch.Tensor:
+        return torch.empty_like(x)
+
+    def _setup_context(ctx, inputs, output):
+        x, k, mask, h_past, n_past = inputs
+        ctx.save_for_backward(x, mask)
+        ctx.k = k
+        ctx.has_past = h_past is not None
+        ctx.n_past = n_past
+
+    def _backward(ctx, grad):
+        x, mask = ctx.saved_tensors
+        dx = fused_polynomial_aggregation_backward(grad, x, ctx.k, mask, ctx.n_past)
+        dh_past = grad * (ctx.n_past / (ctx.n_past + x.shape[1])) if ctx.has_past else None
+        return dx, None, None, dh_past, None
+
+    fused_polynomial_aggregation.register_autograd(_backward, setup_context=_setup_context)
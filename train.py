@@ -369,7 +369,8 @@ def main(cfg: DictConfig):
             for _ in range(cfg.evaluation.val_max_steps):
                 with torch.no_grad():
                     x_val, y_val = val_loader.next_batch()
-                    _, loss = model(x_val, y_val, return_logits=False)
+                    with ctx:
+                        _, loss = model(x_val, y_val, return_logits=False)
                     val_loss += loss
             dist.all_reduce(val_loss, op=dist.ReduceOp.AVG)
             val_loss /= cfg.evaluation.val_max_steps